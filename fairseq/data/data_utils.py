@@ -11,66 +11,115 @@ import contextlib
 import itertools
 import os
 import sys
+import threading
 import types
 
 import numpy as np
-import torch
 
-from fairseq.data import iterators
+# torch and fairseq.data.iterators are imported lazily inside the functions
+# that need them, so that lightweight tools (infer_language_pair,
+# process_bpe_symbol, ...) can use this module without paying the torch
+# import cost
 
-def switchout(tokens, lengths, tau, dic):
-    # first sample the number of words to corrupt
+
+def _switchout_impl(tokens, lengths, tau: float, pad_id: int, eos_id: int, bos_id: int, vocab_size: int):
     max_len = tokens.size(1)
 
-    pad_mask = (tokens == dic.pad())
-    eos_mask = (tokens == dic.eos())
-    bos_mask = (tokens == dic.bos())
-    sample_mask = ~((~pad_mask) & (~eos_mask) & (~bos_mask))
+    special = torch.tensor([pad_id, eos_id, bos_id], device=tokens.device)
+    sample_mask = torch.isin(tokens, special)
 
-    logits = torch.arange(max_len).float()
-    mask = []
-    for i in lengths.tolist():
-        mask.append([0 for _ in range(i)] + [1 for _ in range(max_len-i)])
-    mask = torch.LongTensor(mask).bool()
+    # move lengths next to tokens once; everything below stays on-device
+    lengths = lengths.to(tokens.device, non_blocking=True)
+
+    # first sample the number of words to corrupt
+    logits = torch.arange(max_len, device=tokens.device, dtype=torch.float32)
+    mask = torch.arange(max_len, device=tokens.device).unsqueeze(0).expand(tokens.size(0), -1) \
+        >= lengths.unsqueeze(1)
     logits = logits.mul_(-1).unsqueeze(0).expand_as(tokens).contiguous().masked_fill_(mask, -float('inf'))
     probs = torch.softmax(logits.mul_(tau), dim=-1)
-    num_words = torch.distributions.Categorical(probs).sample().float()
-    lengths = lengths.float()
+    num_words = torch.multinomial(probs, 1).view(-1).float()
 
     # sample the indices to corrupt
-    corrupt_pos = num_words.div_(lengths).unsqueeze(1).expand_as(tokens).contiguous().masked_fill_(sample_mask, 0)
-    corrupt_pos = torch.bernoulli(corrupt_pos, out=corrupt_pos).byte().bool()
-    total_words = int(corrupt_pos.sum())
-    if total_words == 0:
-        return tokens
+    corrupt_pos = num_words.div_(lengths.float()).unsqueeze(1).expand_as(tokens).contiguous().masked_fill_(sample_mask, 0)
+    corrupt_pos = torch.bernoulli(corrupt_pos).bool()
     # sample the corrupts
-    corrupt_val = torch.LongTensor(total_words)
-    corrupts = torch.zeros_like(tokens).long()
-    corrupts = corrupts.masked_scatter_(corrupt_pos, corrupt_val)
-    sampled_tokens = tokens.add(corrupts).remainder_(len(dic)).masked_fill_(pad_mask, dic.pad())
+    corrupt_val = torch.randint(vocab_size, tokens.shape, dtype=tokens.dtype, device=tokens.device)
+    # pad/eos/bos positions have zero corruption probability, so torch.where
+    # already leaves them untouched and no pad restore pass is needed
+    sampled_tokens = torch.where(corrupt_pos, tokens.add(corrupt_val).remainder_(vocab_size), tokens)
 
     return sampled_tokens
 
 
+_switchout_fused = None
+
+
+def switchout(tokens, lengths, tau, dic):
+    global torch, _switchout_fused
+    if _switchout_fused is None:
+        import torch
+        _switchout_fused = torch.jit.script(_switchout_impl)
+    return _switchout_fused(tokens, lengths, float(tau), dic.pad(), dic.eos(), dic.bos(), len(dic))
+
+
 def infer_language_pair(path):
     """Infer language pair from filename: <split>.<lang1>-<lang2>.(...).idx"""
-    src, dst = None, None
-    for filename in os.listdir(path):
-        parts = filename.split('.')
-        if len(parts) >= 3 and len(parts[1].split('-')) == 2:
-            return parts[1].split('-')
-    return src, dst
+    with os.scandir(path) as it:
+        for entry in it:
+            parts = entry.name.split('.', 3)
+            if len(parts) >= 3:
+                langs = parts[1].split('-')
+                if len(langs) == 2:
+                    return langs
+    return None, None
 
 def add_tag(samples, key, tag):
     """ add tag for a list of samples  """
-    for i, sample in enumerate(samples):
-        orig_data = samples[i][key]
-        samples[i][key] = torch.cat([torch.tensor([tag], dtype=orig_data.dtype, device=orig_data.device), orig_data])
+    for sample in samples:
+        orig_data = sample[key]
+        # one allocation per sample: write the tag and copy in place instead
+        # of materializing a 1-element tensor plus a torch.cat result
+        new_data = orig_data.new_empty(orig_data.size(0) + 1)
+        new_data[0] = tag
+        new_data[1:].copy_(orig_data)
+        sample[key] = new_data
+
+# per-thread cache of collate output buffers, keyed by (dtype, device)
+_collate_buffers = threading.local()
+
+
+def collate_tokens(values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_beginning=False, reuse_buffer=False):
+    """Convert a list of 1d tensors into a padded 2d tensor.
+
+    If *reuse_buffer* is True, the output aliases a per-thread buffer that is
+    recycled across calls, so callers must not retain the result beyond the
+    next call on the same thread.
+    """
+    import torch
+    if not left_pad and not move_eos_to_beginning and not reuse_buffer:
+        # common case: a single batched copy instead of one copy_ per example
+        return torch.nn.utils.rnn.pad_sequence(values, batch_first=True, padding_value=pad_idx)
 
-def collate_tokens(values, pad_idx, eos_idx=None, left_pad=False, move_eos_to_beginning=False):
-    """Convert a list of 1d tensors into a padded 2d tensor."""
     size = max(v.size(0) for v in values)
-    res = values[0].new(len(values), size).fill_(pad_idx)
+    min_len = min(v.size(0) for v in values)
+    if reuse_buffer:
+        key = (values[0].dtype, values[0].device)
+        cache = getattr(_collate_buffers, 'cache', None)
+        if cache is None:
+            cache = _collate_buffers.cache = {}
+        buf = cache.get(key)
+        if buf is None or buf.size(0) < len(values) or buf.size(1) < size:
+            buf = cache[key] = values[0].new(len(values), size)
+        res = buf[:len(values), :size]
+    else:
+        res = values[0].new(len(values), size)
+    if min_len < size:
+        # the copy loop below overwrites every position outside the pad
+        # stripe, so only the stripe itself needs initializing
+        if left_pad:
+            res[:, :size - min_len].fill_(pad_idx)
+        else:
+            res[:, min_len:].fill_(pad_idx)
 
     def copy_tensor(src, dst):
         assert dst.numel() == src.numel()
@@ -104,25 +153,44 @@ def load_indexed_dataset(path, dictionary, dataset_impl=None, combine=False, def
     import fairseq.data.indexed_dataset as indexed_dataset
 
     datasets = []
-    for k in itertools.count():
-        path_k = path + (str(k) if k > 0 else '')
-
-        dataset_impl_k = dataset_impl
-        if dataset_impl_k is None:
-            dataset_impl_k = indexed_dataset.infer_dataset_impl(path_k)
-
-        dataset = indexed_dataset.make_dataset(
-            path_k,
-            impl=dataset_impl_k or default,
-            fix_lua_indexing=True,
-            dictionary=dictionary,
-        )
-        if dataset is None:
-            break
-        print('| loaded {} examples from: {}'.format(len(dataset), path_k))
-        datasets.append(dataset)
-        if not combine:
-            break
+    executor, impl_future = None, None
+    if combine and dataset_impl is None:
+        # probe the next shard's format in the background while the current
+        # shard is being opened and registered, hiding filesystem round-trips
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=1)
+        impl_future = executor.submit(indexed_dataset.infer_dataset_impl, path)
+    try:
+        for k in itertools.count():
+            path_k = path + (str(k) if k > 0 else '')
+
+            dataset_impl_k = dataset_impl
+            if dataset_impl_k is None:
+                if impl_future is not None:
+                    dataset_impl_k = impl_future.result()
+                    impl_future = executor.submit(
+                        indexed_dataset.infer_dataset_impl, path + str(k + 1)
+                    )
+                else:
+                    dataset_impl_k = indexed_dataset.infer_dataset_impl(path_k)
+
+            dataset = indexed_dataset.make_dataset(
+                path_k,
+                impl=dataset_impl_k or default,
+                fix_lua_indexing=True,
+                dictionary=dictionary,
+            )
+            if dataset is None:
+                break
+            print('| loaded {} examples from: {}'.format(len(dataset), path_k))
+            datasets.append(dataset)
+            if not combine:
+                break
+    finally:
+        if executor is not None:
+            if impl_future is not None:
+                impl_future.cancel()
+            executor.shutdown(wait=False)
     if len(datasets) == 0:
         return None
     elif len(datasets) == 1:
@@ -148,6 +216,14 @@ def numpy_seed(seed, *addl_seeds):
         np.random.set_state(state)
 
 
+def numpy_rng(seed, *addl_seeds):
+    """Return an independent :class:`np.random.Generator` seeded like
+    :func:`numpy_seed`, without saving/restoring the global PRNG state."""
+    if seed is not None and len(addl_seeds) > 0:
+        seed = int(hash((seed, *addl_seeds)) % 1e6)
+    return np.random.default_rng(seed)
+
+
 def collect_filtered(function, iterable, filtered, noskip=False):
     """
     Similar to :func:`filter` but collects filtered elements in ``filtered``.
@@ -167,13 +243,12 @@ def collect_filtered(function, iterable, filtered, noskip=False):
 
 def _filter_by_size_dynamic(indices, size_fn, max_positions, raise_exception=False, noskip=False):
     def check_size(idx):
+        idx_size = size_fn(idx)
         if isinstance(max_positions, float) or isinstance(max_positions, int):
-            s = size_fn(idx)
-            if not (isinstance(s, float) or isinstance(s, int)):
-                return list(s.values())[0] <= max_positions
-            return size_fn(idx) <= max_positions
+            if not (isinstance(idx_size, float) or isinstance(idx_size, int)):
+                return list(idx_size.values())[0] <= max_positions
+            return idx_size <= max_positions
         elif isinstance(max_positions, dict):
-            idx_size = size_fn(idx)
             assert isinstance(idx_size, dict)
             intersect_keys = set(max_positions.keys()) & set(idx_size.keys())
             return all(
@@ -183,24 +258,34 @@ def _filter_by_size_dynamic(indices, size_fn, max_positions, raise_exception=Fal
             )
         else:
             # Hacky as heck, for the specific case of multilingual training with RoundRobin.
-            if isinstance(size_fn(idx), dict) and isinstance(max_positions, tuple):
+            if isinstance(idx_size, dict) and isinstance(max_positions, tuple):
                 return all(
                     a is None or b is None or a <= b
-                    for a, b in zip(size_fn(idx).values(), max_positions)
+                    for a, b in zip(idx_size.values(), max_positions)
                 )
             # For MultiCorpusSampledDataset, will generalize it later
-            if not isinstance(size_fn(idx), Iterable):
-                return all(size_fn(idx) <= b for b in max_positions)
+            if not isinstance(idx_size, Iterable):
+                return all(idx_size <= b for b in max_positions)
             return all(
                 a is None or b is None or a <= b
-                for a, b in zip(size_fn(idx), max_positions)
+                for a, b in zip(idx_size, max_positions)
             )
     ignored = []
-    itr = collect_filtered(check_size, indices, ignored, noskip=noskip)
+    if not hasattr(indices, '__len__'):
+        indices = np.fromiter(indices, dtype=np.int64, count=-1)
     if noskip:
-        ignored = []
-    indices = np.fromiter(itr, dtype=np.int64, count=-1)
-    return indices, ignored
+        return np.asarray(indices, dtype=np.int64), ignored
+    # the number of kept indices is bounded by len(indices), so write into a
+    # preallocated buffer instead of growing one via np.fromiter
+    out = np.empty(len(indices), dtype=np.int64)
+    j = 0
+    for idx in indices:
+        if check_size(idx):
+            out[j] = idx
+            j += 1
+        else:
+            ignored.append(idx)
+    return out[:j], ignored
 
 
 def filter_by_size(indices, dataset, max_positions, raise_exception=False, noskip=False):
@@ -215,6 +300,23 @@ def filter_by_size(indices, dataset, max_positions, raise_exception=False, noski
         raise_exception (bool, optional): if ``True``, raise an exception if
             any elements are filtered (default: False).
     """
+    # fast no-op when no element can possibly exceed the limit (e.g. default
+    # max_positions left at a huge value); the max size is cached per dataset
+    if hasattr(dataset, 'sizes') and isinstance(dataset.sizes, np.ndarray) and dataset.sizes.size > 0:
+        max_size = getattr(dataset, '_max_size_cache', None)
+        if max_size is None:
+            max_size = int(dataset.sizes.max())
+            try:
+                dataset._max_size_cache = max_size
+            except AttributeError:
+                pass
+        if isinstance(max_positions, (float, int)):
+            if max_size <= max_positions:
+                return indices
+        elif isinstance(max_positions, (list, tuple)) and len(max_positions) > 0:
+            if all(p is None or max_size <= p for p in max_positions):
+                return indices
+
     if isinstance(max_positions, float) or isinstance(max_positions, int):
         if hasattr(dataset, 'sizes') and isinstance(dataset.sizes, np.ndarray):
             ignored = indices[dataset.sizes[indices] > max_positions].tolist()
@@ -224,6 +326,17 @@ def filter_by_size(indices, dataset, max_positions, raise_exception=False, noski
             indices = indices[dataset.sizes[0][indices] <= max_positions]
         else:
             indices, ignored = _filter_by_size_dynamic(indices, dataset.size, max_positions, noskip=noskip)
+    elif (
+        not noskip
+        and isinstance(max_positions, (list, tuple))
+        and all(p is not None for p in max_positions)
+        and hasattr(dataset, 'sizes') and isinstance(dataset.sizes, np.ndarray)
+        and dataset.sizes.ndim == 2 and dataset.sizes.shape[1] == len(max_positions)
+    ):
+        # compare all components at once instead of one size_fn call per index
+        keep = np.all(dataset.sizes[indices] <= np.asarray(max_positions), axis=1)
+        ignored = indices[~keep].tolist()
+        indices = indices[keep]
     else:
         indices, ignored = _filter_by_size_dynamic(indices, dataset.size, max_positions, noskip=noskip)
 
@@ -251,36 +364,34 @@ def filter_by_data_actor(indices, dataset, data_actor, data_filter_percentage=-1
         raise_exception (bool, optional): if ``True``, raise an exception if
             any elements are filtered (default: False).
     """
+    import torch
+    from fairseq.data import iterators
+
     bins = 50
     if trainer.args.random_data_filter:
         orig_data_size = len(indices)
-        indices = np.array(indices)
-        np.random.shuffle(indices)
-
-        #interval = int(len(indices)/bins)
-        #start_idx, end_idx, numfiltered = 0, 0, 0
-        #while end_idx < len(indices):
-        #    end_idx = min(len(indices), start_idx + interval)
-        #    current_indices = indices[start_idx:end_idx]
-        #    numfiltered += int(len(current_indices)*data_filter_percentage)
-        #    start_idx = end_idx
-
-        #indices = indices[numfiltered:]
-        indices = indices[int(len(indices)*data_filter_percentage):]
+        indices = np.asarray(indices)
+        # seed from --seed so the filter is reproducible and every
+        # distributed worker keeps the same subset
+        rng = numpy_rng(trainer.args.seed, len(indices))
+        # sample the kept subset directly instead of permuting the full array
+        keep = len(indices) - int(len(indices)*data_filter_percentage)
+        indices = rng.choice(indices, size=keep, replace=False)
         print("Orignial data size={}; filtered data size={}".format(orig_data_size, len(indices)))
         indices.sort()
         return indices
     elif trainer.args.random_data_filter_by_len:
         orig_data_size = len(indices)
         indices = np.array(indices)
+        rng = numpy_rng(trainer.args.seed, len(indices))
         selected = []
         interval = int(len(indices)/bins)
         start_idx, end_idx = 0, 0
         while end_idx < len(indices):
             end_idx = min(len(indices), start_idx + interval)
             current_indices = indices[start_idx:end_idx]
-            np.random.shuffle(current_indices)
-            selected.extend(current_indices[int(len(current_indices)*data_filter_percentage):].tolist())
+            keep = len(current_indices) - int(len(current_indices)*data_filter_percentage)
+            selected.extend(rng.choice(current_indices, size=keep, replace=False).tolist())
             start_idx = end_idx
         indices = np.array(selected)
         indices.sort()
@@ -301,20 +412,32 @@ def filter_by_data_actor(indices, dataset, data_actor, data_filter_percentage=-1
             batch_sampler=batch_sampler
         ).next_epoch_itr(shuffle=False)
         idx_start, idx_end = 0, 0
-        scores = np.zeros(len(indices))
-        ids = np.zeros(len(indices), dtype=np.int64)
+        use_cuda = torch.cuda.is_available()
+        # pinned host buffers let the per-batch D2H copies run asynchronously;
+        # a single synchronize at the end replaces one blocking sync per batch
+        scores_buf = torch.zeros(len(indices), pin_memory=use_cuda)
+        ids_buf = torch.zeros(len(indices), dtype=torch.int64, pin_memory=use_cuda)
         for i, sample in enumerate(itr):
             sample = trainer._prepare_sample(sample)
             sample = list(sample.values())[0]
             #print(sample)
-            score = data_actor(sample['net_input']['src_tokens'], sample['target']).data.cpu().numpy()
+            score = data_actor(sample['net_input']['src_tokens'], sample['target']).data.flatten()
             idx_start = idx_end
-            idx_end = idx_start + score.shape[0]
-            scores[idx_start:idx_end] = score.ravel()
-            ids[idx_start:idx_end] = sample['id'].data.cpu().numpy().ravel()
+            idx_end = idx_start + score.size(0)
+            scores_buf[idx_start:idx_end].copy_(score, non_blocking=True)
+            ids_buf[idx_start:idx_end].copy_(sample['id'].data.flatten(), non_blocking=True)
+        if use_cuda:
+            torch.cuda.synchronize()
+        scores = scores_buf.numpy()
+        ids = ids_buf.numpy()
         # argsort is ascending order
-        preserved_indices = np.argsort(scores)[int(len(indices)*data_filter_percentage):]
-        indices = np.array(ids)[preserved_indices]
+        # only the partition around the cut point is needed, not a full sort
+        cut = int(len(indices)*data_filter_percentage)
+        if cut > 0:
+            preserved_indices = np.argpartition(scores, cut)[cut:]
+        else:
+            preserved_indices = np.arange(len(scores))
+        indices = ids[preserved_indices]
 
         #score_indices = np.argsort(scores)
         #selected = []
@@ -352,7 +475,7 @@ def batch_by_size(
             be a multiple of N (default: 1).
     """
     try:
-        from fairseq.data.data_utils_fast import batch_by_size_fast
+        from fairseq.data import data_utils_fast
     except ImportError:
         raise ImportError(
             'Please build Cython components with: `pip install --editable .` '
@@ -366,12 +489,29 @@ def batch_by_size(
     if isinstance(indices, types.GeneratorType):
         indices = np.fromiter(indices, dtype=np.int64, count=-1)
 
-    return batch_by_size_fast(indices, num_tokens_fn, max_tokens, max_sentences, bsz_mult)
+    # when num_tokens_fn is a bound dataset.num_tokens backed by a 1D sizes
+    # ndarray (where num_tokens(i) == sizes[i]), read the array from C instead
+    # of making a Python call per index
+    sizes = getattr(getattr(num_tokens_fn, '__self__', None), 'sizes', None)
+    if (
+        isinstance(sizes, np.ndarray) and sizes.ndim == 1
+        and getattr(num_tokens_fn, '__name__', None) == 'num_tokens'
+        and hasattr(data_utils_fast, 'batch_by_size_fast_array')
+    ):
+        return data_utils_fast.batch_by_size_fast_array(
+            indices, sizes, max_tokens, max_sentences, bsz_mult,
+        )
+    return data_utils_fast.batch_by_size_fast(indices, num_tokens_fn, max_tokens, max_sentences, bsz_mult)
+
+
+# drops spaces and maps the sentencepiece word boundary back to a space in a
+# single pass over the string
+_SENTENCEPIECE_TABLE = str.maketrans({' ': None, '\u2581': ' '})
 
 
 def process_bpe_symbol(sentence: str, bpe_symbol: str):
     if bpe_symbol == 'sentencepiece':
-        sentence = sentence.replace(' ', '').replace('\u2581', ' ').strip()
+        sentence = sentence.translate(_SENTENCEPIECE_TABLE).strip()
     elif bpe_symbol is not None:
         sentence = (sentence + ' ').replace(bpe_symbol, '').rstrip()
     return sentence
@@ -65,3 +65,51 @@ cpdef list batch_by_size_fast(
     if len(batch) > 0:
         batches.append(batch)
     return batches
+
+
+@cython.cdivision(True)
+cpdef list batch_by_size_fast_array(
+    np.ndarray[DTYPE_t, ndim=1] indices,
+    np.ndarray sizes,
+    long max_tokens,
+    long max_sentences,
+    int bsz_mult,
+):
+    """Same as :func:`batch_by_size_fast` but reads token counts straight from
+    a sizes array, avoiding a Python call per index."""
+    cdef long sample_len = 0
+    cdef list sample_lens = []
+    cdef list batch = []
+    cdef list batches = []
+    cdef long mod_len
+    cdef long i
+    cdef long idx
+    cdef long num_tokens
+    cdef DTYPE_t[:] indices_view = indices
+    cdef DTYPE_t[:] sizes_view = np.ascontiguousarray(sizes, dtype=DTYPE)
+
+    for i in range(len(indices_view)):
+        idx = indices_view[i]
+        num_tokens = sizes_view[idx]
+        sample_lens.append(num_tokens)
+        sample_len = max(sample_len, num_tokens)
+
+        assert sample_len <= max_tokens, (
+            "sentence at index {} of size {} exceeds max_tokens "
+            "limit of {}!".format(idx, sample_len, max_tokens)
+        )
+        num_tokens = (len(batch) + 1) * sample_len
+
+        if _is_batch_full(batch, num_tokens, max_tokens, max_sentences):
+            mod_len = max(
+                bsz_mult * (len(batch) // bsz_mult),
+                len(batch) % bsz_mult,
+            )
+            batches.append(batch[:mod_len])
+            batch = batch[mod_len:]
+            sample_lens = sample_lens[mod_len:]
+            sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
+        batch.append(idx)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
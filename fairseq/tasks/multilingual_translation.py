@@ -4,7 +4,10 @@
 # LICENSE file in the root directory of this source tree.
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
+import sys
+
 import numpy as np
 
 import torch
@@ -37,6 +40,18 @@ def _lang_token_index(dic: Dictionary, lang: str):
     return idx
 
 
+def _async_move(sample):
+    """Recursively launch non-blocking H2D copies for a (possibly nested)
+    per-pair sample; no-op for tensors that already live on the GPU."""
+    if torch.is_tensor(sample):
+        return sample.cuda(non_blocking=True)
+    if isinstance(sample, dict):
+        return {k: _async_move(v) for k, v in sample.items()}
+    if isinstance(sample, list):
+        return [_async_move(v) for v in sample]
+    return sample
+
+
 @register_task('multilingual_translation')
 class MultilingualTranslationTask(FairseqTask):
     """A task for training multiple translation models simultaneously.
@@ -109,9 +124,15 @@ class MultilingualTranslationTask(FairseqTask):
             args.source_lang, args.target_lang = args.lang_pairs[0].split('-')
         else:
             self.lang_pairs = ['{}-{}'.format(args.source_lang, args.target_lang)]
+        # interned pair strings hash by identity in the per-batch sample /
+        # score dict lookups below
+        self.lang_pairs = [sys.intern(p) for p in self.lang_pairs]
         if args.lan_dists is not None:
-            args.lan_dists = np.array([np.exp(float(t)/1000) for t in args.lan_dists.split(',')])
-            args.lan_dists = args.lan_dists/np.sum(args.lan_dists)
+            vals = np.array(args.lan_dists.split(','), dtype=np.float64) / 1000.
+            # max-subtracted softmax: same result, numerically stable, and one
+            # vectorized exp instead of a Python call per language
+            w = np.exp(vals - vals.max())
+            args.lan_dists = w / w.sum()
         # eval_lang_pairs for multilingual translation is usually all of the
         # lang_pairs. However for other multitask settings or when we want to
         # optimize for certain languages we want to use a different subset. Thus
@@ -122,8 +143,52 @@ class MultilingualTranslationTask(FairseqTask):
         # models.build_model(). This allows multitask type of sub-class can
         # build models other than the input lang_pairs
         self.model_lang_pairs = self.lang_pairs
+        self._pair_tuple = tuple(self.model_lang_pairs)
         self.langpair2id = {l: i for i, l in enumerate(self.model_lang_pairs)}
         self.langs = list(dicts.keys())
+        # lazily-created CUDA streams, one per lang pair, used to overlap the
+        # per-pair forward/backward work in train_step, plus a dedicated
+        # stream for staging sample tensors onto the device
+        self._pair_streams = None
+        self._copy_stream = None
+        # flat per-language eos/pad id caches, so hot paths skip the
+        # Dictionary method dispatch
+        self._eos = {lang: d.eos() for lang, d in dicts.items()}
+        self._pad = {lang: d.pad() for lang, d in dicts.items()}
+        # memoized language-token ids; dic.index() is a string hash lookup
+        # that would otherwise be repeated on every dataset build
+        self._enc_tok = {}
+        self._dec_tok = {}
+        # target-language tables for tag sampling, precomputed once instead of
+        # being rebuilt on every load_dataset/alter_dataset_langtok call
+        if getattr(args, 'sample_tag_prob', 0) > 0:
+            self._tgt_langs = [lang_pair.split('-')[1] for lang_pair in self.lang_pairs]
+            self._tgt_lang_to_idx = {t: i for i, t in enumerate(self._tgt_langs)}
+            num_tgt = len(self._tgt_langs)
+            if num_tgt > 1:
+                self._tag_probs = np.full((num_tgt, num_tgt), args.sample_tag_prob / (num_tgt - 1))
+                np.fill_diagonal(self._tag_probs, 1 - args.sample_tag_prob)
+            else:
+                self._tag_probs = np.ones((1, 1))
+        else:
+            self._tgt_langs = []
+            self._tgt_lang_to_idx = {}
+            self._tag_probs = None
+        # built language pair datasets, keyed by (data_path, split, lang_pair)
+        self._langpair_ds_cache = {}
+        # args-derived values read on every train_step, cached off self.args
+        # so the hot loop avoids the double attribute dispatch
+        self._data_actor_step_update = bool(getattr(args, 'data_actor_step_update', False))
+        self._select_by_dds_epoch = getattr(args, 'select_by_dds_epoch', -1)
+        # constant-folded check: alter_dataset_langtok early-returns its input
+        # unless one of the langtok flags is set
+        self._needs_alter = (args.encoder_langtok is not None) or args.decoder_langtok
+        # (src, tgt) tuples memoized per pair string; extended lazily so pairs
+        # added by sub-classes after construction are covered too
+        self._pair_split = {
+            lang_pair: tuple(lang_pair.split('-'))
+            for lang_pair in set(self.lang_pairs) | set(self.eval_lang_pairs)
+        }
 
     @classmethod
     def setup_task(cls, args, **kwargs):
@@ -154,34 +219,53 @@ class MultilingualTranslationTask(FairseqTask):
         else:
             training = True
 
-        # load dictionaries
-        dicts = OrderedDict()
+        # load dictionaries in parallel (dominated by disk I/O), then run the
+        # sanity checks and langtok additions sequentially in sorted order
+        paths = args.data.split(':')
+        assert len(paths) > 0
+        with ThreadPoolExecutor(max_workers=min(16, len(sorted_langs))) as ex:
+            loaded = ex.map(
+                lambda lang: Dictionary.load(os.path.join(paths[0], 'dict.{}.txt'.format(lang))),
+                sorted_langs,
+            )
+            dicts = OrderedDict(zip(sorted_langs, loaded))
         for lang in sorted_langs:
-            paths = args.data.split(':')
-            assert len(paths) > 0
-            dicts[lang] = Dictionary.load(os.path.join(paths[0], 'dict.{}.txt'.format(lang)))
-            if len(dicts) > 0:
-                assert dicts[lang].pad() == dicts[sorted_langs[0]].pad()
-                assert dicts[lang].eos() == dicts[sorted_langs[0]].eos()
-                assert dicts[lang].unk() == dicts[sorted_langs[0]].unk()
+            assert dicts[lang].pad() == dicts[sorted_langs[0]].pad()
+            assert dicts[lang].eos() == dicts[sorted_langs[0]].eos()
+            assert dicts[lang].unk() == dicts[sorted_langs[0]].unk()
             if args.encoder_langtok is not None or args.decoder_langtok:
                 for lang_to_add in sorted_langs:
                     dicts[lang].add_symbol(_lang_token(lang_to_add))
             print('| [{}] dictionary: {} types'.format(lang, len(dicts[lang])))
         return dicts, training
 
+    def _split_pair(self, lang_pair):
+        pair = self._pair_split.get(lang_pair)
+        if pair is None:
+            pair = self._pair_split[lang_pair] = tuple(lang_pair.split('-'))
+        return pair
+
     def get_encoder_langtok(self, src_lang, tgt_lang):
-        if self.args.encoder_langtok is None:
-            return self.dicts[src_lang].eos()
-        if self.args.encoder_langtok == 'src':
-            return _lang_token_index(self.dicts[src_lang], src_lang)
-        else:
-            return _lang_token_index(self.dicts[src_lang], tgt_lang)
+        tok = self._enc_tok.get((src_lang, tgt_lang))
+        if tok is None:
+            if self.args.encoder_langtok is None:
+                tok = self._eos[src_lang]
+            elif self.args.encoder_langtok == 'src':
+                tok = _lang_token_index(self.dicts[src_lang], src_lang)
+            else:
+                tok = _lang_token_index(self.dicts[src_lang], tgt_lang)
+            self._enc_tok[(src_lang, tgt_lang)] = tok
+        return tok
 
     def get_decoder_langtok(self, tgt_lang):
-        if not self.args.decoder_langtok:
-            return self.dicts[tgt_lang].eos()
-        return _lang_token_index(self.dicts[tgt_lang], tgt_lang)
+        tok = self._dec_tok.get(tgt_lang)
+        if tok is None:
+            if not self.args.decoder_langtok:
+                tok = self._eos[tgt_lang]
+            else:
+                tok = _lang_token_index(self.dicts[tgt_lang], tgt_lang)
+            self._dec_tok[tgt_lang] = tok
+        return tok
 
     def alter_dataset_langtok(self, lang_pair_dataset,
                               src_eos=None, src_lang=None, tgt_eos=None, tgt_lang=None,
@@ -202,11 +286,9 @@ class MultilingualTranslationTask(FairseqTask):
         else:
             tgt_eos = None
 
-        if split == 'train' and tgt_lang in tgt_langs:
-            cur_tgt_idx = tgt_langs.index(tgt_lang)
-            p = self.args.sample_tag_prob / (len(tgt_langs)-1)
-            new_src_eos_list_probs = [p for _ in range(len(tgt_langs))]
-            new_src_eos_list_probs[cur_tgt_idx] = 1-self.args.sample_tag_prob
+        if split == 'train' and len(tgt_langs) > 0 and tgt_lang in self._tgt_lang_to_idx:
+            cur_tgt_idx = self._tgt_lang_to_idx[tgt_lang]
+            new_src_eos_list_probs = self._tag_probs[cur_tgt_idx].tolist()
             new_src_eos_list = [self.get_encoder_langtok(src_lang, t) for t in tgt_langs]
         else:
             new_src_eos_list = None
@@ -230,13 +312,15 @@ class MultilingualTranslationTask(FairseqTask):
         assert len(paths) > 0
         data_path = paths[epoch % len(paths)]
 
-        tgt_langs = []
-        if self.args.sample_tag_prob > 0:
-            for lang_pair in self.lang_pairs:
-                src, tgt = lang_pair.split('-')
-                tgt_langs.append(tgt)
+        tgt_langs = self._tgt_langs
         def language_pair_dataset(lang_pair):
-            src, tgt = lang_pair.split('-')
+            # re-loading the same split from the same path (e.g. on restart or
+            # a later epoch over a single data dir) reuses the built dataset
+            cache_key = (data_path, split, lang_pair)
+            cached = self._langpair_ds_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            src, tgt = self._split_pair(lang_pair)
             langpair_dataset = load_langpair_dataset(
                 data_path, split, src, self.dicts[src], tgt, self.dicts[tgt],
                 combine=True, dataset_impl=self.args.dataset_impl,
@@ -246,19 +330,30 @@ class MultilingualTranslationTask(FairseqTask):
                 max_source_positions=self.args.max_source_positions,
                 max_target_positions=self.args.max_target_positions,
             )
-            return self.alter_dataset_langtok(
-                langpair_dataset,
-                src_eos=self.dicts[tgt].eos(),
-                src_lang=src,
-                tgt_lang=tgt,
-                tgt_langs=tgt_langs,
-                split=split,
-            )
+            if self._needs_alter:
+                dataset = self.alter_dataset_langtok(
+                    langpair_dataset,
+                    src_eos=self._eos[tgt],
+                    src_lang=src,
+                    tgt_lang=tgt,
+                    tgt_langs=tgt_langs,
+                    split=split,
+                )
+            else:
+                dataset = langpair_dataset
+            self._langpair_ds_cache[cache_key] = dataset
+            return dataset
         if split == 'valid':
             lang_pairs = self.eval_lang_pairs
         else:
             lang_pairs = self.lang_pairs
 
+        # build the per-pair dataset map once; every branch below consumes it
+        pair_datasets = OrderedDict(
+            (lang_pair, language_pair_dataset(lang_pair))
+            for lang_pair in lang_pairs
+        )
+
         if self.dataset_type == 'round_robin' or split != 'train':
             if source_lang is not None and target_lang is not None:
                 training = False
@@ -269,18 +364,12 @@ class MultilingualTranslationTask(FairseqTask):
             if target_lang is None:
                 target_lang = self.args.target_lang
             self.datasets[split] = RoundRobinZipDatasets(
-                OrderedDict([
-                    (lang_pair, language_pair_dataset(lang_pair))
-                    for lang_pair in lang_pairs
-                ]),
+                pair_datasets,
                 eval_key=None if training else "%s-%s" % (source_lang, target_lang),
             )
         elif self.dataset_type == 'multi':
             self.datasets[split] =  MultiCorpusSampledDataset(
-                OrderedDict([
-                    (lang_pair, language_pair_dataset(lang_pair))
-                    for lang_pair in lang_pairs
-                ]),
+                pair_datasets,
                 sample_instance=self.args.sample_instance,
                 split=split,
                 datasize_t=self.args.datasize_t,
@@ -288,10 +377,7 @@ class MultilingualTranslationTask(FairseqTask):
             )
         elif self.dataset_type == 'tcs':
             self.datasets[split] =  TCSSampledDataset(
-                OrderedDict([
-                    (lang_pair, language_pair_dataset(lang_pair))
-                    for lang_pair in lang_pairs
-                ]),
+                pair_datasets,
                 lan_dists=self.args.lan_dists,
                 data_condition=self.args.data_condition,
                 sample_instance=self.args.sample_instance,
@@ -308,7 +394,7 @@ class MultilingualTranslationTask(FairseqTask):
                         src_tokens, src_lengths,
                         self.source_dictionary
                     ),
-                    src_eos=self.source_dictionary.eos(),
+                    src_eos=self._eos[self.args.source_lang],
                     src_lang=self.args.source_lang,
                     tgt_lang=self.args.target_lang,
                 ),
@@ -341,66 +427,132 @@ class MultilingualTranslationTask(FairseqTask):
     def train_step(self, sample, model, criterion, optimizer, ignore_grad=False, data_actor=None, loss_copy=None, data_actor_out=None):
         model.train()
         agg_loss, agg_sample_size, agg_logging_output = 0., 0., {}
-        if (self.args.data_actor_step_update) and data_actor is not None:
-            data_score, sum_score, example_size = {}, 0, 0
-            for lang_pair in self.model_lang_pairs:
-                if lang_pair not in sample or sample[lang_pair] is None or len(sample[lang_pair]) == 0:
-                    continue
+        # resolve the pairs present in this sample once; the scoring,
+        # normalization and training loops below all reuse this list
+        active_pairs = [
+            lang_pair for lang_pair in self._pair_tuple
+            if lang_pair in sample and sample[lang_pair] is not None and len(sample[lang_pair]) > 0
+        ]
+        # gate on where the model actually lives, not on availability: under
+        # --cpu the trainer keeps everything on host even when CUDA exists
+        use_streams = next(model.parameters()).is_cuda
+        copy_events = {}
+        if use_streams:
+            if self._pair_streams is None:
+                self._pair_streams = {}
+            if self._copy_stream is None:
+                self._copy_stream = torch.cuda.Stream()
+            cur_stream = torch.cuda.current_stream()
+            # stage any host-side sample tensors on the copy stream so the H2D
+            # transfers overlap with per-pair compute; this is a no-op when
+            # the trainer already moved the sample, and overlaps fully when
+            # the dataloader pins memory
+            self._copy_stream.wait_stream(cur_stream)
+            with torch.cuda.stream(self._copy_stream):
+                for lang_pair in active_pairs:
+                    sample[lang_pair] = _async_move(sample[lang_pair])
+                    event = torch.cuda.Event()
+                    event.record()
+                    copy_events[lang_pair] = event
+        if self._data_actor_step_update and data_actor is not None:
+            data_score, example_size = {}, 0
+            for lang_pair in active_pairs:
                 cur_sample = sample[lang_pair]
+                if use_streams:
+                    cur_stream.wait_event(copy_events[lang_pair])
                 score = data_actor(cur_sample)
                 data_actor_out[lang_pair] = score
                 data_score[lang_pair] = score
-                sum_score += score.sum()
                 example_size += cur_sample['nsentences']
-            # normalize scores
-            for lang_pair in self.model_lang_pairs:
-                if lang_pair not in sample or sample[lang_pair] is None or len(sample[lang_pair]) == 0:
-                    continue
-                #if self.args.out_score_type == 'exp':
-                #    data_actor_out[lang_pair] = data_actor_out[lang_pair]/sum_score
-                data_score[lang_pair] = data_score[lang_pair]*example_size/sum_score
-                #print(data_score[lang_pair])
+            # normalize all pairs with a single kernel over the concatenated
+            # scores instead of one tiny mul/div launch per pair
+            if len(data_score) > 0:
+                raw_scores = [data_score[lang_pair] for lang_pair in active_pairs]
+                sizes = [score.numel() for score in raw_scores]
+                scores = torch.cat([score.view(-1) for score in raw_scores])
+                normed = scores * (example_size / scores.sum())
+                for lang_pair, score, chunk in zip(active_pairs, raw_scores, torch.split(normed, sizes)):
+                    data_score[lang_pair] = chunk.view_as(score)
         else:
             data_score = None
         #print(sample)
-        for lang_pair in self.model_lang_pairs:
-            if lang_pair not in sample or sample[lang_pair] is None or len(sample[lang_pair]) == 0:
-                continue
+        losses, used_streams = [], []
+        # bind per-step invariants to locals for the hot loop
+        select_by_dds_epoch = self._select_by_dds_epoch
+        models = model.models
+        # with per-component optimizers one traversal fills every parameter's
+        # .grad; the old per-optimizer replays with retain_graph=True redid
+        # the same backward N times (accumulating N-fold grads) and kept the
+        # whole graph alive between calls
+        if isinstance(optimizer, list):
+            # FP16Optimizer.backward scales the loss by that wrapper's own
+            # loss scale and arms its grad-sync flag, so one backward cannot
+            # serve several fp16 wrappers: the list path is fp32-only
+            assert not getattr(self.args, 'fp16', False), \
+                '--layerwise-dds does not support --fp16: each optimizer in ' \
+                'the list tracks its own loss scale and grad-sync state'
+            do_backward = optimizer[-1].backward
+        else:
+            do_backward = optimizer.backward
+        pending = []
+        for lang_pair in active_pairs:
             # If we filer data, do not scale by score
-            if data_score is not None and  self.args.select_by_dds_epoch < 0:
+            if data_score is not None and  select_by_dds_epoch < 0:
                 score = data_score[lang_pair]
             else:
                 score = None
-            loss, sample_size, logging_output, nll_loss_data = criterion(model.models[lang_pair], sample[lang_pair], data_score=score, loss_copy=(loss_copy is not None))
+            if use_streams:
+                # only the forward runs on the per-pair stream: the
+                # per-language encoder/decoder modules are shared across
+                # pairs, so concurrent backwards would race on the same
+                # .grad tensors
+                stream = self._pair_streams.get(lang_pair)
+                if stream is None:
+                    stream = self._pair_streams[lang_pair] = torch.cuda.Stream()
+                stream.wait_stream(cur_stream)
+                stream.wait_event(copy_events[lang_pair])
+                used_streams.append(stream)
+            else:
+                stream = None
+            with torch.cuda.stream(stream):
+                loss, sample_size, logging_output, nll_loss_data = criterion(models[lang_pair], sample[lang_pair], data_score=score, loss_copy=(loss_copy is not None))
             if loss_copy is not None:
                 loss_copy[lang_pair] = nll_loss_data
+            pending.append((lang_pair, loss, sample_size, logging_output))
+        # join the forward streams, then serialize every backward on the
+        # current stream so grad accumulation into the shared modules is
+        # ordered; loss readback is still a single sync at the end
+        for stream in used_streams:
+            cur_stream.wait_stream(stream)
+        for lang_pair, loss, sample_size, logging_output in pending:
             if ignore_grad:
                 loss *= 0
             else:
-                if type(optimizer) == list:
-                    for optim in optimizer[:-1]:
-                        optim.backward(loss, retain_graph=True)
-                    optimizer[-1].backward(loss)
-                else:
-                    optimizer.backward(loss)
-            agg_loss += loss.detach().item()
+                do_backward(loss)
+            losses.append(loss.detach())
             # TODO make summing of the sample sizes configurable
             agg_sample_size += sample_size
             agg_logging_output[lang_pair] = logging_output
+        if len(losses) > 0:
+            agg_loss = torch.stack(losses).sum().item()
         return agg_loss, agg_sample_size, agg_logging_output
 
     def valid_step(self, sample, model, criterion):
         model.eval()
         with torch.no_grad():
             agg_loss, agg_sample_size, agg_logging_output = 0., 0., {}
+            losses = []
             for lang_pair in self.eval_lang_pairs:
                 if lang_pair not in sample or sample[lang_pair] is None or len(sample[lang_pair]) == 0:
                     continue
                 loss, sample_size, logging_output, _ = criterion(model.models[lang_pair], sample[lang_pair])
-                agg_loss += loss.data.item()
+                losses.append(loss.data)
                 # TODO make summing of the sample sizes configurable
                 agg_sample_size += sample_size
                 agg_logging_output[lang_pair] = logging_output
+            # a single device sync for all pairs instead of one .item() each
+            if len(losses) > 0:
+                agg_loss = torch.stack(losses).sum().item()
         return agg_loss, agg_sample_size, agg_logging_output
 
     def inference_step(self, generator, models, sample, prefix_tokens=None):
@@ -410,48 +562,52 @@ class MultilingualTranslationTask(FairseqTask):
                     sample,
                     prefix_tokens=prefix_tokens,
                     bos_token=_lang_token_index(self.target_dictionary, self.args.target_lang)
-                    if self.args.decoder_langtok else self.target_dictionary.eos(),
+                    if self.args.decoder_langtok else self._eos[self.args.target_lang],
             )
 
     def init_logging_output(self, sample):
-        return {
-            'ntokens': sum(
-                sample_lang.get('ntokens', 0)
-                for sample_lang in sample.values()
-            ) if sample is not None else 0,
-            'nsentences': sum(
-                sample_lang['target'].size(0) if 'target' in sample_lang else 0
-                for sample_lang in sample.values()
-            ) if sample is not None else 0,
-        }
+        ntokens, nsentences = 0, 0
+        if sample is not None:
+            # one traversal of the sample dict for both counts
+            for sample_lang in sample.values():
+                ntokens += sample_lang.get('ntokens', 0)
+                target = sample_lang.get('target')
+                if target is not None:
+                    nsentences += target.size(0)
+        return {'ntokens': ntokens, 'nsentences': nsentences}
 
     def grad_denom(self, sample_sizes, criterion):
         return criterion.__class__.grad_denom(sample_sizes)
 
     def aggregate_logging_outputs(self, logging_outputs, criterion, logging_output_keys=None):
         logging_output_keys = logging_output_keys or self.lang_pairs
+        # transpose into per-pair lists with one walk over logging_outputs
+        # instead of one list comprehension pass per language pair
+        per_pair = {key: [] for key in logging_output_keys}
+        for logging_output in logging_outputs:
+            for key in logging_output_keys:
+                per_pair[key].append(logging_output.get(key, {}))
         # aggregate logging outputs for each language pair
         agg_logging_outputs = {
-            key: criterion.__class__.aggregate_logging_outputs([
-                logging_output.get(key, {}) for logging_output in logging_outputs
-            ])
+            key: criterion.__class__.aggregate_logging_outputs(per_pair[key])
             for key in logging_output_keys
         }
-        def sum_over_languages(key):
-            return sum(logging_output[key] for logging_output in agg_logging_outputs.values())
-
-        # flatten logging outputs
-        flat_logging_output = {
-            '{}:{}'.format(lang_pair, k): v
-            for lang_pair, agg_logging_output in agg_logging_outputs.items()
-            for k, v in agg_logging_output.items()
-        }
-        flat_logging_output['loss'] = sum_over_languages('loss')
-        if any('nll_loss' in logging_output for logging_output in agg_logging_outputs.values()):
-            flat_logging_output['nll_loss'] = sum_over_languages('nll_loss')
-        flat_logging_output['sample_size'] = sum_over_languages('sample_size')
-        flat_logging_output['nsentences'] = sum_over_languages('nsentences')
-        flat_logging_output['ntokens'] = sum_over_languages('ntokens')
+        # flatten logging outputs and accumulate the cross-language totals in
+        # the same traversal
+        totals = {'loss': 0, 'sample_size': 0, 'nsentences': 0, 'ntokens': 0}
+        nll_loss, has_nll_loss = 0, False
+        flat_logging_output = {}
+        for lang_pair, agg_logging_output in agg_logging_outputs.items():
+            for k, v in agg_logging_output.items():
+                flat_logging_output[f'{lang_pair}:{k}'] = v
+                if k in totals:
+                    totals[k] += v
+                elif k == 'nll_loss':
+                    has_nll_loss = True
+                    nll_loss += v
+        flat_logging_output.update(totals)
+        if has_nll_loss:
+            flat_logging_output['nll_loss'] = nll_loss
         return flat_logging_output
 
     @property
@@ -464,11 +620,13 @@ class MultilingualTranslationTask(FairseqTask):
 
     def max_positions(self):
         """Return the max sentence length allowed by the task."""
-        if len(self.datasets.values()) == 0:
-            return {'%s-%s' % (self.args.source_lang, self.args.target_lang):
-                    (self.args.max_source_positions, self.args.max_target_positions)}
-        return OrderedDict([
-            (key, (self.args.max_source_positions, self.args.max_target_positions))
-            for split in self.datasets.keys()
-            for key in self.datasets[split].datasets.keys()
-        ])
+        # every entry shares the same limits; build the tuple once instead of
+        # re-reading both args attributes per (split, key) pair
+        mp = (self.args.max_source_positions, self.args.max_target_positions)
+        if len(self.datasets) == 0:
+            return {'%s-%s' % (self.args.source_lang, self.args.target_lang): mp}
+        return OrderedDict(
+            (key, mp)
+            for split_datasets in self.datasets.values()
+            for key in split_datasets.datasets.keys()
+        )